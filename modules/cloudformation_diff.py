@@ -96,10 +96,19 @@ options:
         default: 'template'
         aliases: []
 
+    cache_template:
+        description:
+            - Cache the parsed local template in a private directory below the system temp directory, keyed by a hash of its contents.
+            - Unchanged templates are then not parsed again on subsequent runs.
+        required: false
+        default: false
+        aliases: []
+
 requirements:
     - python >= 2.6
     - boto3 >= 1.0.0
     - cfn_flip
+    - orjson (optional, for faster sorted json output)
 extends_documentation_fragment:
     - aws
     - ec2
@@ -185,12 +194,10 @@ diff:
 # Python default imports
 import os
 import json
+import datetime
+import hashlib
+import tempfile
 import traceback
-try:
-    from collections import OrderedDict
-except ImportError:
-    OrderedDict = dict
-
 from functools import partial
 
 # Python Custom libraries
@@ -198,10 +205,24 @@ from functools import partial
 # $ pip install cfn_flip
 try:
     from cfn_flip import flip, to_yaml, to_json
+    # PyYAML is a dependency of cfn_flip
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
     HAS_CFN_FLIP = True
 except ImportError:
     HAS_CFN_FLIP = False
 
+# Optional, faster sorted json serialization
+# $ pip install orjson
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 try:
     import boto3
     import botocore
@@ -215,6 +236,27 @@ from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_bytes, to_native
 
 
+# Ansible module input parameter (in addition to the ec2 ones)
+CFNDIFF_ARGUMENT_SPEC = dict(
+    stack_name=dict(required=True, type='str'),
+    template=dict(required=True, type='path'),
+    template_parameters=dict(required=False, type='dict', default={}),
+    template_tags=dict(required=False, type='dict', default={}),
+    ignore_template_desc=dict(required=False, type='bool', default=False),
+    ignore_hidden_params=dict(required=False, type='bool', default=False),
+    ignore_final_newline=dict(required=False, type='bool', default=False),
+    output_format=dict(required=False, default='json', choices=('json', 'yaml')),
+    output_choice=dict(required=False, default='template', choices=('template', 'parameter', 'tags')),
+    cache_template=dict(required=False, type='bool', default=False),
+)
+
+# Maximum number of parsed local templates kept in the on-disk cache
+CFNDIFF_CACHE_SIZE = 32
+
+# Part of the cache key, bump it whenever the parsed format changes
+CFNDIFF_CACHE_VERSION = '1'
+
+
 ################################################################################
 #
 #  C L A S S E S
@@ -269,29 +311,15 @@ class CloudFormationServiceManager:
         The 'result_key' is used to define the concatenated results that are combined from each paginated response.
         '''
         args = dict()
-        if next_token:
-            args['NextToken'] = next_token
-        response = func(**args)
-        result = response.get(result_key)
-        next_token = response.get('NextToken')
-        if not next_token:
-            return result
-        return result + self.paginated_response(func, result_key, next_token)
-
-
-class SortedDict(OrderedDict):
-    '''
-    This class adds a custom recursive JSON sorter.
-    JSON dicts are sorted recursively and alphabetically by key.
-    '''
-    def __init__(self, **kwargs):
-        super(SortedDict, self).__init__()
-
-        for key, value in sorted(kwargs.items()):
-            if isinstance(value, dict):
-                self[key] = SortedDict(**value)
-            else:
-                self[key] = value
+        result = []
+        while True:
+            if next_token:
+                args['NextToken'] = next_token
+            response = func(**args)
+            result.extend(response.get(result_key) or [])
+            next_token = response.get('NextToken')
+            if not next_token:
+                return result
 
 
 ################################################################################
@@ -300,20 +328,81 @@ class SortedDict(OrderedDict):
 #
 ################################################################################
 
+def json_dumps_sorted(obj):
+    '''
+    Serialize to a json string with all dict keys sorted recursively,
+    by orjson if available, otherwise by json.
+    '''
+    if HAS_ORJSON:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+        except TypeError:
+            # orjson only accepts str dict keys, json also handles the others
+            pass
+    return json.dumps(obj, sort_keys=True)
+
+
+def quote_json_key(key):
+    '''
+    Quote a dict key the same way json.dumps() does (True -> 'true',
+    None -> 'null', ...), so that keys are equal no matter whether the
+    template was parsed by yaml directly or by cfn_flip through json.
+    '''
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+    if isinstance(key, datetime.date):
+        return key.isoformat()
+    return key
+
+
 def quote_json(obj):
     '''
     Treat all json key/values as strings and therefore
-    quote them to be consistent
+    quote them to be consistent.
+    The structure is walked with an explicit stack instead of recursion,
+    so deeply nested templates cannot exceed the recursion limit.
+    Self-referencing structures (recursive yaml anchors) raise a ValueError.
     '''
+    scalars = (str, bool, int, float)
+    root = [obj]
+    stack = [(root, 0, obj)]
+    # ids of the containers from the root down to the current node
+    path = set()
+
+    while stack:
+        parent, key, value = stack.pop()
+        if parent is None:
+            # All children of this container are done, leave it
+            path.discard(key)
+            continue
+        if isinstance(value, (dict, list, tuple)):
+            if id(value) in path:
+                raise ValueError("Circular reference detected in template")
+            path.add(id(value))
+            # Pushed before the children, so it is popped after all of them
+            stack.append((None, id(value), None))
+
+        if isinstance(value, scalars):
+            parent[key] = str(value)
+        elif isinstance(value, datetime.date):
+            # Unquoted yaml dates, stringified the same way as cfn_flip does
+            parent[key] = value.isoformat()
+        elif isinstance(value, dict):
+            node = parent[key] = dict()
+            for item_key, item in value.items():
+                item_key = quote_json_key(item_key)
+                # Reserve the key now to retain the original key order
+                node[item_key] = None
+                stack.append((node, item_key, item))
+        elif isinstance(value, (list, tuple)):
+            node = parent[key] = [None] * len(value)
+            stack.extend((node, index, item) for index, item in enumerate(value))
+        else:
+            parent[key] = value
 
-    # possible nicer way: https://docs.scipy.org/doc/numpy/reference/arrays.scalars.html
-    if isinstance(obj, (bool, str, int, float, complex)):
-        return str(obj)
-    if isinstance(obj, (list, tuple)):
-        return [quote_json(item) for item in obj]
-    if isinstance(obj, dict):
-        return dict((quote_json(key), quote_json(value)) for key, value in obj.items())
-    return obj
+    return root[0]
 
 
 def del_newline_json(obj):
@@ -322,7 +411,7 @@ def del_newline_json(obj):
     '''
 
     # possible nicer way: https://docs.scipy.org/doc/numpy/reference/arrays.scalars.html
-    if isinstance(obj, (bool, str, int, float, complex)):
+    if isinstance(obj, (str, bool, int, float)):
         return str(obj).rstrip('\r\n')
     if isinstance(obj, (list, tuple)):
         return [del_newline_json(item) for item in obj]
@@ -337,7 +426,7 @@ def to_dict(items, key, value):
     Copied from cloudformation_facts module.
     '''
     if items:
-        return dict(zip([i[key] for i in items], [i[value] for i in items]))
+        return dict((i[key], i[value]) for i in items)
     else:
         return dict()
 
@@ -348,46 +437,39 @@ def to_dict(items, key, value):
 #
 ################################################################################
 
-def cfn_get_noecho_param_names(items):
+def cfn_scan_params(items):
     '''
-    Get a list of all parameter names which have 'NoEcho = true'.
+    Scan the template parameter dict in a single pass and return
+    the parameters with a default value defined as well as the
+    names of all parameters which have 'NoEcho = true'.
+    Return form: ({ "<param-name>": "<default-value>", ...}, set(["<param-name>", ...]))
     '''
-    if items:
-        data = []
-        for i in items:
-            if 'NoEcho' in items[i]:
-                if str(items[i]['NoEcho']).lower() == 'true':
-                    data.append(i)
-        return data
-    else:
-        return []
-
-
-def cfn_get_default_value_params(items):
+    defaults = dict()
+    hidden = set()
+    for name, param in (items or {}).items():
+        if 'Default' in param:
+            defaults[name] = param['Default']
+        if 'NoEcho' in param:
+            if str(param['NoEcho']).lower() == 'true':
+                hidden.add(name)
+    return defaults, hidden
+
+
+def load_json_or_yaml(data):
     '''
-    Extract only the parameters from the template item dict
-    which have a default value defined.
-    Extraction form: { "<param-name>": "<default-value>", ...}
-    '''
-    if items:
-        data = {}
-        for i in items:
-            if 'Default' in items[i]:
-                data[i] = items[i]['Default']
-        return data
-    else:
-        return dict()
-
-
-def get_json_or_yaml(data, output_format='json'):
-    '''
-    Convert into json or yaml from
-    json or yaml.
+    Parse a json or yaml string into a python dict.
+    The C accelerated json and yaml loaders are tried first, cfn_flip is
+    only required for yaml with short form functions such as !Ref or !Sub.
     '''
+    try:
+        return json.loads(data)
+    except ValueError:
+        pass
 
-    # Make all dicts a string first
-    if isinstance(data, dict):
-        data = json.dumps(data)
+    try:
+        return yaml.load(data, Loader=SafeLoader)
+    except yaml.YAMLError:
+        pass
 
     # Get JSON, no matter what input (yaml or json)
     try:
@@ -397,21 +479,103 @@ def get_json_or_yaml(data, output_format='json'):
         data = to_json(data)
 
     # Create python dict
-    data = json.loads(data)
+    return json.loads(data)
 
-    # Sort python dict
-    data = SortedDict(**data)
+
+def get_json_or_yaml(data, output_format='json', drop_keys=()):
+    '''
+    Convert into json or yaml from
+    json or yaml.
+    Top-level keys listed in drop_keys are removed from the result.
+    '''
+
+    # Dicts are already parsed, only strings need to be converted
+    if not isinstance(data, dict):
+        data = load_json_or_yaml(data)
 
     # Quote keys
     data = quote_json(data)
 
+    # Remove unwanted keys (quote_json returned a copy)
+    for key in drop_keys:
+        data.pop(key, None)
+
     # Return json or yaml
+    # Keys are sorted recursively by the json encoder
     if output_format == 'yaml':
-        data = to_yaml(json.dumps(data))
+        data = to_yaml(json_dumps_sorted(data))
 
     return data
 
 
+def get_cache_dir():
+    '''
+    Return the private per-user cache directory, create it if required.
+    A directory not owned by us or accessible by others is refused.
+    '''
+    path = os.path.join(tempfile.gettempdir(), 'cfndiff-%d' % os.getuid())
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise OSError("insecure cache directory %s" % (path))
+    return path
+
+
+def get_json_cached(data):
+    '''
+    Same as get_json_or_yaml(data, 'json') for the raw template bytes 'data',
+    but the result is cached on disk, keyed by a hash of the contents and
+    the cache version. Unchanged templates are therefore only parsed once.
+    Any cache error falls back to parsing the template.
+    '''
+    digest = hashlib.sha256(to_bytes(CFNDIFF_CACHE_VERSION) + b':' + data).hexdigest()
+    try:
+        cache_dir = get_cache_dir()
+        cache_file = os.path.join(cache_dir, 'cfndiff-%s.json' % digest)
+    except (IOError, OSError):
+        return get_json_or_yaml(data, 'json')
+
+    # Cache hit, mark it as recently used
+    try:
+        with open(cache_file, 'rb') as f:
+            obj = json.loads(f.read())
+        os.utime(cache_file, None)
+        return obj
+    except (IOError, OSError, ValueError):
+        pass
+
+    # Return the json round-trip on a miss as well, so that a cache miss
+    # and a cache hit always give the same result.
+    obj = get_json_or_yaml(data, 'json')
+    try:
+        payload = json.dumps(obj)
+    except (TypeError, ValueError):
+        return obj
+    obj = json.loads(payload)
+
+    # Atomically write the cache file and evict the least recently used ones
+    tmp_file = None
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(to_bytes(payload))
+        os.rename(tmp_file, cache_file)
+        tmp_file = None
+
+        cache_files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                       if name.startswith('cfndiff-') and name.endswith('.json')]
+        if len(cache_files) > CFNDIFF_CACHE_SIZE:
+            cache_files.sort(key=os.path.getmtime)
+            for name in cache_files[:-CFNDIFF_CACHE_SIZE]:
+                os.remove(name)
+    except (IOError, OSError):
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return obj
+
+
 def cfndiff_module_validation(module):
     '''
     Validate for correct module call/usage in ansible.
@@ -444,17 +608,7 @@ def main():
     '''
     # Ansible module input parameter
     argument_spec = ec2_argument_spec()
-    argument_spec.update(dict(
-        stack_name=dict(required=True, type='str'),
-        template=dict(required=True, type='path'),
-        template_parameters=dict(required=False, type='dict', default={}),
-        template_tags=dict(required=False, type='dict', default={}),
-        ignore_template_desc=dict(required=False, type='bool', default=False),
-        ignore_hidden_params=dict(required=False, type='bool', default=False),
-        ignore_final_newline=dict(required=False, type='bool', default=False),
-        output_format=dict(required=False, default='json', choices=['json', 'yaml']),
-        output_choice=dict(required=False, default='template', choices=['template', 'parameter', 'tags']),
-    ))
+    argument_spec.update(CFNDIFF_ARGUMENT_SPEC)
 
     # This module should actually only be run in check mode ;-)
     module = AnsibleModule(
@@ -484,15 +638,36 @@ def main():
     cloud_tags = to_dict(cloud_data.get('Tags', []), 'Key', 'Value')
 
     # Get local data
-    with open(module.params.get('template'), "rt") as f:
-        local_template = f.read().decode("UTF-8")
+    # Kept as raw bytes, the json and yaml parsers decode UTF-8 themselves
+    with open(module.params.get('template'), 'rb') as f:
+        local_template = f.read()
+
+    # Byte-identical templates cannot differ in any output format,
+    # so only the local one needs to be parsed and rendered.
+    identical_template = (
+        output_choice == 'template' and
+        not isinstance(cloud_template, dict) and
+        to_bytes(cloud_template, errors='surrogate_or_strict') == local_template
+    )
+
+    # Parse both templates only once and only for the diff modes using them.
+    # boto3 already returns json templates as dict, which are not parsed again.
+    cloud_obj = dict()
+    local_obj = dict()
+    if output_choice == 'template' and not identical_template:
+        cloud_obj = get_json_or_yaml(cloud_template, 'json')
+    if output_choice in ('template', 'parameter'):
+        if module.params.get('cache_template'):
+            local_obj = get_json_cached(local_template)
+        else:
+            local_obj = get_json_or_yaml(local_template, 'json')
 
     # Ignore final newline?
     #
     # When yes, then we remove final newlines
     if ignore_final_newline:
-        cloud_template = del_newline_json(get_json_or_yaml(cloud_template, 'json'))
-        local_template = del_newline_json(get_json_or_yaml(local_template, 'json'))
+        cloud_obj = del_newline_json(cloud_obj)
+        local_obj = del_newline_json(local_obj)
         cloud_params = del_newline_json(get_json_or_yaml(cloud_params, 'json'))
         local_params = del_newline_json(get_json_or_yaml(local_params, 'json'))
         cloud_tags = del_newline_json(get_json_or_yaml(cloud_tags, 'json'))
@@ -505,20 +680,14 @@ def main():
     # So the user can request to ignore it.
     if output_choice == 'template':
 
-        if ignore_template_desc:
-            # Need json Dict for .pop()
-            cloud_dict = get_json_or_yaml(cloud_template, 'json')
-            local_dict = get_json_or_yaml(local_template, 'json')
-            # remove
-            cloud_dict.pop('Description', None)
-            local_dict.pop('Description', None)
-            # Whatever format the user requested
-            cloud_dict = get_json_or_yaml(cloud_dict, output_format)
-            local_dict = get_json_or_yaml(local_dict, output_format)
+        drop_keys = ('Description',) if ignore_template_desc else ()
+
+        # Convert to nice yaml/json output
+        local_dict = get_json_or_yaml(local_obj, output_format, drop_keys=drop_keys)
+        if identical_template:
+            cloud_dict = local_dict
         else:
-            # Convert to nice yaml/json output
-            cloud_dict = get_json_or_yaml(cloud_template, output_format)
-            local_dict = get_json_or_yaml(local_template, output_format)
+            cloud_dict = get_json_or_yaml(cloud_obj, output_format, drop_keys=drop_keys)
 
     # 1. Upstream AWS can have more parameters as specified in 'template_parameters'.
     # This is due to the fact, that the template itself has a 'Parameters' section
@@ -541,32 +710,40 @@ def main():
     elif output_choice == 'parameter':
         # Get local paramers from template and parameter definition
         param_params = get_json_or_yaml(local_params, 'json')
-        templ_params = get_json_or_yaml(local_template, 'json').get('Parameters')
+        # local_obj is already parsed and quoted, no need to convert it again
+        templ_params = local_obj.get('Parameters') or {}
 
         # Extract only the template parameters which have a 'Default' value
-        templ_def_params = cfn_get_default_value_params(templ_params)
+        # and the ones which are hidden by 'NoEcho'
+        templ_def_params, hidden_params = cfn_scan_params(templ_params)
 
         # Merge parameters from parameters and templates default parametsrs
         # param_params comes 2nd and will overwrite any already available default
         # parameters from the template.
-        local_params = templ_def_params.copy()
-        local_params.update(param_params)
+        local_params = dict(templ_def_params, **param_params)
 
         if ignore_hidden_params:
-            hidden_params = cfn_get_noecho_param_names(templ_params)
             cloud_params = get_json_or_yaml(cloud_params, 'json')
             for key in hidden_params:
                 local_params.pop(key, None)
                 cloud_params.pop(key, None)
 
         # Convert final local params to nice yaml/json output
+        # Equal parameters only need to be converted once
         local_dict = get_json_or_yaml(local_params, output_format)
-        cloud_dict = get_json_or_yaml(cloud_params, output_format)
+        if cloud_params == local_params:
+            cloud_dict = local_dict
+        else:
+            cloud_dict = get_json_or_yaml(cloud_params, output_format)
 
     elif output_choice == 'tags':
         # Convert to nice yaml/json output
-        cloud_dict = get_json_or_yaml(cloud_tags, output_format)
+        # Equal tags only need to be converted once
         local_dict = get_json_or_yaml(local_tags, output_format)
+        if cloud_tags == local_tags:
+            cloud_dict = local_dict
+        else:
+            cloud_dict = get_json_or_yaml(cloud_tags, output_format)
 
     # Ansible diff output
     diff = {